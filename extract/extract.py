@@ -1,22 +1,36 @@
-from functools import partial
+import os
+import time
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Callable, List, Optional, Tuple
 
 import cv2
 import fire
 import numpy as np
+import scipy.ndimage
+import scipy.sparse
 import torch
 import torch.nn.functional as F
-from accelerate import Accelerator
 from PIL import Image
 from scipy.sparse.linalg import eigsh
-from sklearn.cluster import KMeans, MiniBatchKMeans
-from sklearn.decomposition import PCA
-from torchvision.utils import draw_bounding_boxes
+from torchvision.ops import roi_align
 from tqdm import tqdm
 
 import extract_utils as utils
 
+# 3x3 structuring element for morphological operations on segmaps
+_MORPH_K3 = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+
+
+@lru_cache(maxsize=None)
+def _tab20_color_lut():
+    """A read-only uint8 label -> RGB lookup table, where the background (label 0) is black as in label2rgb."""
+    from matplotlib.cm import get_cmap  # imported here, so that matplotlib is only loaded when visualizing
+    color_lut = np.round(get_cmap('tab20', 21).colors[:, :3] * 255).astype(np.uint8)
+    color_lut[0] = 0
+    color_lut.setflags(write=False)
+    return color_lut
+
 
 def extract_features(
     images_list: str,
@@ -25,9 +39,12 @@ def extract_features(
     batch_size: int,
     output_dir: str,
     which_block: int = -1,
+    compile_model: bool = False,
 ):
     """
-    Extract features from a list of images.
+    Extract features from a list of images. If compile_model is set, the model is compiled 
+    with torch.compile, which pays off when most images share the same size, as each new 
+    size triggers a recompilation.
 
     Example:
         python extract.py extract_features \
@@ -57,25 +74,35 @@ def extract_features(
     # Dataset
     filenames = Path(images_list).read_text().splitlines()
     dataset = utils.ImagesDataset(filenames=filenames, images_root=images_root, transform=val_transform)
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=8)
+    num_workers = min(8, os.cpu_count() or 1)
+    dataloader = torch.utils.data.DataLoader(
+        dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True, 
+        persistent_workers=(num_workers > 0), prefetch_factor=(4 if num_workers > 0 else None))
     print(f'Dataset size: {len(dataset)=}')
     print(f'Dataloader size: {len(dataloader)=}')
 
     # Prepare
+    from accelerate import Accelerator
     accelerator = Accelerator(fp16=True, cpu=False)
     # model, dataloader = accelerator.prepare(model, dataloader)
     model = model.to(accelerator.device)
+    get_intermediate_layers = model.get_intermediate_layers
+    if compile_model:
+        get_intermediate_layers = torch.compile(get_intermediate_layers, mode='reduce-overhead', dynamic=False)
+
+    # Output store, to which features are appended
+    store = utils.FeatureStore(output_dir)
 
     # Process
-    pbar = tqdm(dataloader, desc='Processing')
+    batches = utils.prefetch_to_device(dataloader, lambda batch, to: (to(batch[0]), *batch[1:]), accelerator.device)
+    pbar = tqdm(batches, total=len(dataloader), desc='Processing')
     for i, (images, files, indices) in enumerate(pbar):
         output_dict = {}
 
-        # Check if file already exists
+        # Check if features already exist
         id = Path(files[0]).stem
-        output_file = Path(output_dir) / f'{id}.pth'
-        if output_file.is_file():
-            pbar.write(f'Skipping existing file {str(output_file)}')
+        if id in store:
+            pbar.write(f'Skipping existing features {id}')
             continue
 
         # Reshape image
@@ -85,163 +112,265 @@ def extract_features(
         H_pad, W_pad = H_patch * P, W_patch * P
         T = H_patch * W_patch + 1  # number of tokens, add 1 for [CLS]
         # images = F.interpolate(images, size=(H_pad, W_pad), mode='bilinear')  # resize image
-        images = images[:, :, :H_pad, :W_pad]
-        images = images.to(accelerator.device)
+        images = images[:, :, :H_pad, :W_pad]  # already on the device, see utils.prefetch_to_device
 
         # Forward and collect features into output dict
         if 'dino' in model_name or 'mocov3' in model_name:
             # accelerator.unwrap_model(model).get_intermediate_layers(images)[0].squeeze(0)
-            model.get_intermediate_layers(images)[0].squeeze(0)
+            get_intermediate_layers(images)[0].squeeze(0)
             # output_dict['out'] = out
             output_qkv = feat_out["qkv"].reshape(B, T, 3, num_heads, -1 // num_heads).permute(2, 0, 3, 1, 4)
             # output_dict['q'] = output_qkv[0].transpose(1, 2).reshape(B, T, -1)[:, 1:, :]
-            output_dict['k'] = output_qkv[1].transpose(1, 2).reshape(B, T, -1)[:, 1:, :]
+            output_dict['k'] = output_qkv[1].transpose(1, 2).reshape(B, T, -1)[:, 1:, :].half()  # stored as fp16
             # output_dict['v'] = output_qkv[2].transpose(1, 2).reshape(B, T, -1)[:, 1:, :]
         else:
             raise ValueError(model_name)
 
         # Metadata
-        output_dict['indices'] = indices[0]
-        output_dict['file'] = files[0]
-        output_dict['id'] = id
-        output_dict['model_name'] = model_name
-        output_dict['patch_size'] = patch_size
-        output_dict['shape'] = (B, C, H, W)
-        output_dict = {k: (v.detach().cpu() if torch.is_tensor(v) else v) for k, v in output_dict.items()}
+        metadata = {}
+        metadata['indices'] = indices[0].item()
+        metadata['file'] = files[0]
+        metadata['model_name'] = model_name
+        metadata['patch_size'] = patch_size
+        metadata['shape'] = (B, C, H, W)
 
         # Save
-        accelerator.save(output_dict, str(output_file))
+        store.append(id, output_dict, metadata)
         accelerator.wait_for_everyone()
     
+    store.close()
     print(f'Saved features to {output_dir}')
 
 
-def _extract_eig(
-    inp: Tuple[int, str], 
-    K: int, 
+def _color_affinity(
+    data_dict: dict,
+    images_root: str,
+    which_color_matrix: str = 'knn',
+    image_downsample_factor: Optional[int] = None,
+):
+    """Computes the color affinity matrix of the downsampled image on the CPU."""
+
+    # Get sizes
+    B, C, H, W, P, H_patch, W_patch, H_pad, W_pad = utils.get_image_sizes(data_dict)
+    if image_downsample_factor is None:
+        image_downsample_factor = P
+    H_pad_lr, W_pad_lr = H_pad // image_downsample_factor, W_pad // image_downsample_factor
+
+    # Load image
+    image_id = data_dict['file'][:-4]
+    image_file = str(Path(images_root) / f'{image_id}.jpg')
+    image = cv2.cvtColor(utils.imread(image_file), cv2.COLOR_BGR2RGB)
+    image_lr = cv2.resize(image, dsize=(W_pad_lr, H_pad_lr), interpolation=cv2.INTER_AREA)
+    image_lr = image_lr * (1.0 / 255.0)  # scale to [0, 1], as float64, which pymatting expects
+
+    # Color affinities (of type scipy.sparse.csr_matrix)
+    if which_color_matrix == 'knn':
+        W_lr = utils.knn_affinity(image_lr)
+    elif which_color_matrix == 'rw':
+        W_lr = utils.rw_affinity(image_lr)
+    
+    # Keep sparse, as COO (indices, values), which are scattered into the dense feature affinities on the GPU
+    W_lr = W_lr.tocoo()
+    indices = torch.from_numpy(np.stack([W_lr.row, W_lr.col]).astype(np.int64))
+    values = torch.from_numpy(W_lr.data.astype(np.float32))
+    return indices, values
+
+
+def _build_laplacian(
+    data_dict: dict,
+    feats: torch.Tensor,
+    W_color: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+    threshold_at_zero: bool = True,
+    image_downsample_factor: Optional[int] = None,
+    image_color_lambda: float = 10,
+):
+    """Builds the Laplacian L = D - W of the (feature + color) affinity matrix W on the GPU. Returns (L, D)."""
+
+    # Get sizes
+    B, C, H, W, P, H_patch, W_patch, H_pad, W_pad = utils.get_image_sizes(data_dict)
+    if image_downsample_factor is None:
+        image_downsample_factor = P
+    H_pad_lr, W_pad_lr = H_pad // image_downsample_factor, W_pad // image_downsample_factor
+
+    # Upscale features to match the resolution
+    if (H_patch, W_patch) != (H_pad_lr, W_pad_lr):
+        feats = F.interpolate(
+            feats.T.reshape(1, -1, H_patch, W_patch), 
+            size=(H_pad_lr, W_pad_lr), mode='bilinear', align_corners=False
+        ).reshape(-1, H_pad_lr * W_pad_lr).T
+
+    ### Feature affinities 
+    W_feat = (feats @ feats.T)
+    if threshold_at_zero:
+        W_feat.clamp_(min=0)
+    W_feat.div_(W_feat.max())  # NOTE: If features are normalized, this naturally does nothing
+    
+    ### Color affinities, which are computed beforehand by _color_affinity as sparse (indices, values)
+    W_comb = W_feat
+    if W_color is not None:
+        indices, values = W_color
+        W_comb.index_put_(tuple(indices), values * image_color_lambda, accumulate=True)  # combination
+
+    # Combine
+    D_comb = W_comb.sum(dim=1)
+    D_comb[D_comb < 1e-12] = 1.0  # prevent division by zero, see utils.get_diagonal
+    return torch.diag(D_comb) - W_comb, D_comb
+
+
+def _laplacian_eigsh_cpu(L: torch.Tensor, D: torch.Tensor, K: int, lapnorm: bool = True):
+    """Computes the K smallest eigenpairs of the Laplacian L with scipy on the CPU."""
+    L, M = L.cpu().numpy(), (scipy.sparse.diags(D.cpu().numpy()) if lapnorm else None)
+    try:
+        eigenvalues, eigenvectors = eigsh(L, k=K, sigma=0, which='LM', M=M)
+    except:
+        eigenvalues, eigenvectors = eigsh(L, k=K, which='SM', M=M)
+    return torch.from_numpy(eigenvalues), torch.from_numpy(eigenvectors.T).float()
+
+
+def _laplacian_eigh(Ls: List[torch.Tensor], Ds: List[torch.Tensor], K: int, lapnorm: bool = True):
+    """
+    Computes the K smallest eigenpairs of a batch of Laplacians L = D - W with a single batched call 
+    to torch.linalg.eigh on the GPU. With lapnorm, this solves the generalized problem L v = λ D v by 
+    way of the symmetric normalized Laplacian D^{-1/2} L D^{-1/2}, and the eigenvectors are scaled back 
+    to be D-orthonormal, as with scipy's eigsh. Laplacians of different sizes are padded to a common 
+    size with a diagonal block whose eigenvalues lie above the spectrum of the Laplacian, so that the 
+    K smallest eigenpairs are unaffected. Falls back to scipy's eigsh on the CPU if the GPU solver 
+    does not converge.
+    """
+    
+    # Normalize
+    if lapnorm:
+        As = [D.rsqrt()[:, None] * L * D.rsqrt()[None, :] for L, D in zip(Ls, Ds)]
+    else:
+        As = Ls
+
+    # Pad and stack
+    N = max(A.shape[0] for A in As)
+    A_batch = As[0].new_zeros(len(As), N, N)
+    for i, A in enumerate(As):
+        n = A.shape[0]
+        pad = torch.arange(n, N, device=A.device)
+        A_batch[i, :n, :n] = A
+        A_batch[i, pad, pad] = A.abs().sum(dim=1).max() + 1  # above the Gershgorin bound of A
+    
+    # Extract eigenvectors
+    try:
+        eigenvalues, eigenvectors = torch.linalg.eigh(A_batch)
+    except torch.linalg.LinAlgError:
+        print('GPU eigensolver did not converge, falling back to scipy')
+        return [_laplacian_eigsh_cpu(L, D, K=K, lapnorm=lapnorm) for L, D in zip(Ls, Ds)]
+
+    # Unpad
+    outputs = []
+    for i, (A, D) in enumerate(zip(As, Ds)):
+        n = A.shape[0]
+        _eigenvalues, _eigenvectors = eigenvalues[i, :K], eigenvectors[i, :n, :K]
+        if lapnorm:
+            _eigenvectors = D.rsqrt()[:, None] * _eigenvectors
+        outputs.append((_eigenvalues, _eigenvectors.T))
+    return outputs
+
+
+def _load_eig_inputs(
+    inp: Tuple[int, str],
     images_root: str,
+    features_dir: str,
     output_dir: str,
     which_matrix: str = 'laplacian',
     which_features: str = 'k',
-    normalize: bool = True,
-    lapnorm: bool = True,
     which_color_matrix: str = 'knn',
-    threshold_at_zero: bool = True,
     image_downsample_factor: Optional[int] = None,
     image_color_lambda: float = 10,
 ):
-    index, features_file = inp
+    """Loads the features of an image and computes its color affinities. Runs in CPU worker processes."""
+    index, id = inp
 
     # Load 
-    data_dict = torch.load(features_file, map_location='cpu')
+    store = utils.get_feature_store(features_dir)
+    data_dict = store.metadata(id)
     image_id = data_dict['file'][:-4]
-    
-    # Load
     output_file = str(Path(output_dir) / f'{image_id}.pth')
-    if Path(output_file).is_file():
-        print(f'Skipping existing file {str(output_file)}')
-        return  # skip because already generated
 
-    # Load affinity matrix
-    feats = data_dict[which_features].squeeze().cuda()
-    if normalize:
-        feats = F.normalize(feats, p=2, dim=-1)
-
-    # Eigenvectors of affinity matrix
-    if which_matrix == 'affinity_torch':
-        W = feats @ feats.T
-        if threshold_at_zero:
-            W = (W * (W > 0))
-        eigenvalues, eigenvectors = torch.eig(W, eigenvectors=True)
-        eigenvalues = eigenvalues.cpu()
-        eigenvectors = eigenvectors.cpu()
+    # Features, copied out of the memory-mapped store so that they can be sent between processes
+    feats = store.tensor(id, which_features).squeeze().clone()
+    
+    # Color affinities
+    W_color = None
+    if which_matrix in ['matting_laplacian', 'laplacian'] and image_color_lambda > 0:
+        W_color = _color_affinity(data_dict, images_root=images_root, which_color_matrix=which_color_matrix, 
+                                  image_downsample_factor=image_downsample_factor)
     
-    # Eigenvectors of affinity matrix with scipy
-    elif which_matrix == 'affinity_svd':        
-        USV = torch.linalg.svd(feats, full_matrices=False)
-        eigenvectors = USV[0][:, :K].T.to('cpu', non_blocking=True)
-        eigenvalues = USV[1][:K].to('cpu', non_blocking=True)
-
-    # Eigenvectors of affinity matrix with scipy
-    elif which_matrix == 'affinity':
-        W = (feats @ feats.T)
-        if threshold_at_zero:
-            W = (W * (W > 0))
-        W = W.cpu().numpy()
-        eigenvalues, eigenvectors = eigsh(W, which='LM', k=K)
-        eigenvectors = torch.flip(torch.from_numpy(eigenvectors), dims=(-1,)).T
-
-    # Eigenvectors of matting laplacian matrix
-    elif which_matrix in ['matting_laplacian', 'laplacian']:
-
-        # Get sizes
-        B, C, H, W, P, H_patch, W_patch, H_pad, W_pad = utils.get_image_sizes(data_dict)
-        if image_downsample_factor is None:
-            image_downsample_factor = P
-        H_pad_lr, W_pad_lr = H_pad // image_downsample_factor, W_pad // image_downsample_factor
-
-        # Upscale features to match the resolution
-        if (H_patch, W_patch) != (H_pad_lr, W_pad_lr):
-            feats = F.interpolate(
-                feats.T.reshape(1, -1, H_patch, W_patch), 
-                size=(H_pad_lr, W_pad_lr), mode='bilinear', align_corners=False
-            ).reshape(-1, H_pad_lr * W_pad_lr).T
-
-        ### Feature affinities 
-        W_feat = (feats @ feats.T)
-        if threshold_at_zero:
-            W_feat = (W_feat * (W_feat > 0))
-        W_feat = W_feat / W_feat.max()  # NOTE: If features are normalized, this naturally does nothing
-        W_feat = W_feat.cpu().numpy()
+    return output_file, data_dict, feats, W_color
+
+
+def _eig_batch_to_device(batch: List[tuple], to: Callable):
+    """Copies the tensors of a batch of _load_eig_inputs outputs with to, see utils.prefetch_to_device."""
+    return [(output_file, data_dict, to(feats), None if W_color is None else tuple(to(t) for t in W_color))
+            for output_file, data_dict, feats, W_color in batch]
+
+
+def _extract_eig(
+    items: List[tuple], 
+    K: int, 
+    which_matrix: str = 'laplacian',
+    normalize: bool = True,
+    lapnorm: bool = True,
+    threshold_at_zero: bool = True,
+    image_downsample_factor: Optional[int] = None,
+    image_color_lambda: float = 10,
+):
+    outputs = {}
+    laplacians = {}
+    for output_file, data_dict, feats, W_color in items:
+
+        # Load affinity matrix
+        feats = feats.float()
+        if normalize:
+            feats = F.normalize(feats, p=2, dim=-1)
+
+        # Eigenvectors of affinity matrix
+        if which_matrix == 'affinity_torch':
+            W = feats @ feats.T
+            if threshold_at_zero:
+                W.clamp_(min=0)
+            eigenvalues, eigenvectors = torch.eig(W, eigenvectors=True)
         
-        ### Color affinities 
-        # If we are fusing with color affinites, then load the image and compute
-        if image_color_lambda > 0:
-
-            # Load image
-            image_file = str(Path(images_root) / f'{image_id}.jpg')
-            image_lr = Image.open(image_file).resize((W_pad_lr, H_pad_lr), Image.BILINEAR)
-            image_lr = np.array(image_lr) / 255.
-
-            # Color affinities (of type scipy.sparse.csr_matrix)
-            if which_color_matrix == 'knn':
-                W_lr = utils.knn_affinity(image_lr / 255)
-            elif which_color_matrix == 'rw':
-                W_lr = utils.rw_affinity(image_lr / 255)
-            
-            # Convert to dense numpy array
-            W_color = np.array(W_lr.todense().astype(np.float32))
+        # Eigenvectors of thresholded affinity matrix, in descending order
+        elif which_matrix == 'affinity' and threshold_at_zero:
+            W = (feats @ feats.T)
+            W.clamp_(min=0)
+            eigenvalues, eigenvectors = torch.linalg.eigh(W)
+            eigenvalues, eigenvectors = eigenvalues[-K:].flip(0), eigenvectors[:, -K:].flip(1).T
+
+        # Eigenvectors of affinity matrix, which are the left singular vectors of the features
+        elif which_matrix in ['affinity', 'affinity_svd']:
+            U, S, _ = torch.linalg.svd(feats, full_matrices=False)
+            eigenvalues, eigenvectors = S[:K] ** 2, U[:, :K].T
+
+        # Eigenvectors of matting laplacian matrix, which are solved for below as a batch
+        elif which_matrix in ['matting_laplacian', 'laplacian']:
+            laplacians[output_file] = _build_laplacian(
+                data_dict, feats, W_color, threshold_at_zero=threshold_at_zero, 
+                image_downsample_factor=image_downsample_factor, image_color_lambda=image_color_lambda)
+            continue
         
-        else:
+        outputs[output_file] = (eigenvalues, eigenvectors)
 
-            # No color affinity
-            W_color = 0
+    # Extract eigenvectors of all Laplacians in the batch at once
+    if len(laplacians) > 0:
+        Ls, Ds = zip(*laplacians.values())
+        outputs.update(zip(laplacians.keys(), _laplacian_eigh(Ls, Ds, K=K, lapnorm=lapnorm)))
 
-        # Combine
-        W_comb = W_feat + W_color * image_color_lambda  # combination
-        D_comb = np.array(utils.get_diagonal(W_comb).todense())  # is dense or sparse faster? not sure, should check
+    for output_file, (eigenvalues, eigenvectors) in outputs.items():
 
-        # Extract eigenvectors
-        if lapnorm:
-            try:
-                eigenvalues, eigenvectors = eigsh(D_comb - W_comb, k=K, sigma=0, which='LM', M=D_comb)
-            except:
-                eigenvalues, eigenvectors = eigsh(D_comb - W_comb, k=K, which='SM', M=D_comb)
-        else:
-            try:
-                eigenvalues, eigenvectors = eigsh(D_comb - W_comb, k=K, sigma=0, which='LM')
-            except:
-                eigenvalues, eigenvectors = eigsh(D_comb - W_comb, k=K, which='SM')
-        eigenvalues, eigenvectors = torch.from_numpy(eigenvalues), torch.from_numpy(eigenvectors.T).float()
+        # Sign ambiguity
+        pos_frac = (eigenvectors > 0).float().mean(dim=1)
+        flip = (0.5 < pos_frac) & (pos_frac < 1.0)  # reverse segment
+        eigenvectors = torch.where(flip.unsqueeze(1), -eigenvectors, eigenvectors)
 
-    # Sign ambiguity
-    for k in range(eigenvectors.shape[0]):
-        if 0.5 < torch.mean((eigenvectors[k] > 0).float()).item() < 1.0:  # reverse segment
-            eigenvectors[k] = 0 - eigenvectors[k]
-
-    # Save dict
-    output_dict = {'eigenvalues': eigenvalues, 'eigenvectors': eigenvectors}
-    torch.save(output_dict, output_file)
+        # Save dict
+        output_dict = {'eigenvalues': eigenvalues.cpu(), 'eigenvectors': eigenvectors.cpu()}
+        torch.save(output_dict, output_file)
 
 
 def extract_eigs(
@@ -257,10 +386,13 @@ def extract_eigs(
     K: int = 20,
     image_downsample_factor: Optional[int] = None,
     image_color_lambda: float = 0.0,
+    batch_size: int = 32,
     multiprocessing: int = 0
 ):
     """
-    Extracts eigenvalues from features.
+    Extracts eigenvalues from features. Features are loaded and color affinities are computed 
+    in multiprocessing CPU worker processes, while eigenvectors are computed on the GPU in the 
+    main process for batches of batch_size images at a time. 
     
     Example:
         python extract.py extract_eigs \
@@ -271,13 +403,39 @@ def extract_eigs(
             --K 5
     """
     utils.make_output_dir(output_dir)
-    kwargs = dict(K=K, which_matrix=which_matrix, which_features=which_features, which_color_matrix=which_color_matrix,
-                 normalize=normalize, threshold_at_zero=threshold_at_zero, images_root=images_root, output_dir=output_dir, 
-                 image_downsample_factor=image_downsample_factor, image_color_lambda=image_color_lambda, lapnorm=lapnorm)
-    print(kwargs)
+    load_kwargs = dict(which_matrix=which_matrix, which_features=which_features, which_color_matrix=which_color_matrix, 
+                       images_root=images_root, features_dir=features_dir, output_dir=output_dir, 
+                       image_downsample_factor=image_downsample_factor, image_color_lambda=image_color_lambda)
+    kwargs = dict(K=K, which_matrix=which_matrix, normalize=normalize, threshold_at_zero=threshold_at_zero, 
+                  image_downsample_factor=image_downsample_factor, image_color_lambda=image_color_lambda, lapnorm=lapnorm)
+    print({**load_kwargs, **kwargs})
+    load_fn = partial(_load_eig_inputs, **load_kwargs)
     fn = partial(_extract_eig, **kwargs)
-    inputs = list(enumerate(sorted(Path(features_dir).iterdir())))
-    utils.parallel_process(inputs, fn, multiprocessing)
+    inputs = list(enumerate(utils.get_feature_store(features_dir).ids()))
+    done = {p.stem for p in Path(output_dir).glob('*.pth')}
+    inputs = [(i, id) for i, id in inputs if id not in done]  # skip because already generated
+
+    # Producers: CPU workers, which are spawned rather than forked because this process uses CUDA. 
+    # Read-ahead is limited, as items waiting for the GPU are held in shared memory
+    start = time.time()
+    pool = None
+    if multiprocessing:
+        print('Starting multiprocessing')
+        pool = torch.multiprocessing.get_context('spawn').Pool(multiprocessing)
+        items = utils.pool_imap(pool, load_fn, inputs, max_in_flight=2 * batch_size)
+    else:
+        items = map(load_fn, inputs)
+    items = tqdm(items, total=len(inputs))
+
+    # Consumer: the GPU. Each batch is copied to the GPU on a side stream while the previous batch 
+    # is being processed on the compute stream
+    for batch in utils.prefetch_to_device(utils.batched(items, batch_size), _eig_batch_to_device, 'cuda'):
+        fn(batch)
+    
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print(f'Finished in {time.time() - start:.1f}s')
 
 
 def _extract_multi_region_segmentations(
@@ -286,21 +444,19 @@ def _extract_multi_region_segmentations(
     non_adaptive_num_segments: int,
     infer_bg_index: bool,
     kmeans_baseline: bool,
+    features_dir: str,
     output_dir: str,
     num_eigenvectors: int,
+    device: str = 'cpu',
 ):
-    index, (feature_path, eigs_path) = inp
+    index, (id, eigs_path) = inp
 
     # Load 
-    data_dict = torch.load(feature_path, map_location='cpu')
+    data_dict = utils.get_feature_store(features_dir).metadata(id)
     data_dict.update(torch.load(eigs_path, map_location='cpu'))
 
     # Output file
-    id = Path(data_dict['id'])
     output_file = str(Path(output_dir) / f'{id}.png')
-    if Path(output_file).is_file():
-        print(f'Skipping existing file {str(output_file)}')
-        return  # skip because already generated
 
     # Sizes
     B, C, H, W, P, H_patch, W_patch, H_pad, W_pad = utils.get_image_sizes(data_dict)
@@ -317,19 +473,15 @@ def _extract_multi_region_segmentations(
         n_clusters = non_adaptive_num_segments
         # print(f'Number of clusters: {n_clusters}, no adaptive')
 
-    # K-Means
-    kmeans = KMeans(n_clusters=n_clusters, n_init=10) # random set 10 to remove the warning while running
-
     # Compute segments using eigenvector or baseline K-means
     if kmeans_baseline:
-        feats = data_dict['k'].squeeze().numpy()
-        clusters = kmeans.fit_predict(feats)
+        feats = utils.get_feature_store(features_dir).tensor(id, 'k').squeeze().float().to(device)
+        clusters = utils.kmeans(feats, n_clusters=n_clusters, n_init=10).cpu().numpy()
         # print(feats.size(), "kmeans_baseline")
     else:
-        eigenvectors = data_dict['eigenvectors'][1:1+num_eigenvectors].numpy()  # take non-constant eigenvectors
+        eigenvectors = data_dict['eigenvectors'][1:1+num_eigenvectors].float().to(device)  # take non-constant eigenvectors
         # eigenvectors size: 9*527
-        # import pdb; pdb.set_trace()
-        clusters = kmeans.fit_predict(eigenvectors.T)
+        clusters = utils.kmeans(eigenvectors.T.contiguous(), n_clusters=n_clusters, n_init=10).cpu().numpy()
 
     # Reshape
     if clusters.size == H_patch * W_patch:  # TODO: better solution might be to pass in patch index
@@ -356,8 +508,8 @@ def _extract_multi_region_segmentations(
     
     # change happen here. add opening and closing
     segmap = segmap.astype('uint8')
-    # segmap = cv2.morphologyEx(segmap, cv2.MORPH_OPEN, kernel=(3, 3))
-    segmap = cv2.morphologyEx(segmap, cv2.MORPH_CLOSE, kernel=(3, 3))
+    # segmap = cv2.morphologyEx(segmap, cv2.MORPH_OPEN, _MORPH_K3)
+    segmap = cv2.morphologyEx(segmap, cv2.MORPH_CLOSE, _MORPH_K3)
 
     Image.fromarray(segmap).convert('L').save(output_file)
 
@@ -383,28 +535,28 @@ def extract_multi_region_segmentations(
     utils.make_output_dir(output_dir)
     fn = partial(_extract_multi_region_segmentations, adaptive=adaptive, infer_bg_index=infer_bg_index,
                  non_adaptive_num_segments=non_adaptive_num_segments, num_eigenvectors=num_eigenvectors, 
-                 kmeans_baseline=kmeans_baseline, output_dir=output_dir)
-    inputs = utils.get_paired_input_files(features_dir, eigs_dir)
+                 kmeans_baseline=kmeans_baseline, features_dir=features_dir, output_dir=output_dir,
+                 device=('cuda' if torch.cuda.is_available() and not multiprocessing else 'cpu'))
+    inputs = utils.get_paired_feature_files(features_dir, eigs_dir, suffix='.pth')
+    done = {p.stem for p in Path(output_dir).glob('*.png')}
+    inputs = [(i, (id, path)) for i, (id, path) in inputs if id not in done]  # skip because already generated
     utils.parallel_process(inputs, fn, multiprocessing)
 
 
 def _extract_single_region_segmentations(
     inp: Tuple[int, Tuple[str, str]], 
     threshold: float,
+    features_dir: str,
     output_dir: str,
 ):
-    index, (feature_path, eigs_path) = inp
+    index, (id, eigs_path) = inp
 
     # Load 
-    data_dict = torch.load(feature_path, map_location='cpu')
+    data_dict = utils.get_feature_store(features_dir).metadata(id)
     data_dict.update(torch.load(eigs_path, map_location='cpu'))
 
     # Output file
-    id = Path(data_dict['id'])
     output_file = str(Path(output_dir) / f'{id}.png')
-    if Path(output_file).is_file():
-        print(f'Skipping existing file {str(output_file)}')
-        return  # skip because already generated
 
     # Sizes
     B, C, H, W, P, H_patch, W_patch, H_pad, W_pad = utils.get_image_sizes(data_dict)
@@ -432,22 +584,26 @@ def extract_single_region_segmentations(
         --output_dir "./data/VOC2012/single_region_segmentation/patches" \
     """
     utils.make_output_dir(output_dir)
-    fn = partial(_extract_single_region_segmentations, threshold=threshold, output_dir=output_dir)
-    inputs = utils.get_paired_input_files(features_dir, eigs_dir)
+    fn = partial(_extract_single_region_segmentations, threshold=threshold, features_dir=features_dir, 
+                 output_dir=output_dir)
+    inputs = utils.get_paired_feature_files(features_dir, eigs_dir, suffix='.pth')
+    done = {p.stem for p in Path(output_dir).glob('*.png')}
+    inputs = [(i, (id, path)) for i, (id, path) in inputs if id not in done]  # skip because already generated
     utils.parallel_process(inputs, fn, multiprocessing)
 
 
 def _extract_bbox(
-    inp: Tuple[str, str],
+    inp: Tuple[int, Tuple[str, str]],
+    features_dir: str,
     num_erode: int,
     num_dilate: int,
     skip_bg_index: bool,
     downsample_factor: Optional[int] = None
 ):
-    index, (feature_path, segmentation_path) = inp
+    index, (id, segmentation_path) = inp
 
     # Load 
-    data_dict = torch.load(feature_path, map_location='cpu')
+    data_dict = utils.get_feature_store(features_dir).metadata(id)
     segmap = np.array(Image.open(str(segmentation_path)))
     image_id = data_dict['id']
 
@@ -457,18 +613,24 @@ def _extract_bbox(
     # Get bounding boxes
     outputs = {'bboxes': [], 'bboxes_original_resolution': [], 'segment_indices': [], 'id': image_id, 
                'format': "(xmin, ymin, xmax, ymax)"}
-    for segment_index in sorted(np.unique(segmap).tolist()):
-        if (not skip_bg_index) or (segment_index > 0):  # skip 0, because 0 is the background
+    # Find the extent of every segment in a single pass. Labels are shifted by one because 
+    # find_objects ignores 0, which is the background
+    labels = segmap.astype(np.int64) + 1
+    margin = num_erode + num_dilate + 1  # so that eroding/dilating the crop matches the full image
+    for segment_index, slices in enumerate(scipy.ndimage.find_objects(labels)):
+        if (slices is not None) and ((not skip_bg_index) or (segment_index > 0)):  # skip 0, because 0 is the background
             
-            # Erode and dilate mask
-            binary_mask = (segmap == segment_index)
+            # Erode and dilate mask, within a crop around the segment
+            ys, xs = slices
+            y0, x0 = max(ys.start - margin, 0), max(xs.start - margin, 0)
+            binary_mask = (labels[y0:ys.stop + margin, x0:xs.stop + margin] == segment_index + 1)
             binary_mask = utils.erode_or_dilate_mask(binary_mask, r=num_erode, erode=True)
             binary_mask = utils.erode_or_dilate_mask(binary_mask, r=num_dilate, erode=False)
 
             # Find box
             mask = np.where(binary_mask == 1)
-            ymin, ymax = min(mask[0]), max(mask[0]) + 1  # add +1 because excluded max
-            xmin, xmax = min(mask[1]), max(mask[1]) + 1  # add +1 because excluded max
+            ymin, ymax = y0 + min(mask[0]), y0 + max(mask[0]) + 1  # add +1 because excluded max
+            xmin, xmax = x0 + min(mask[1]), x0 + max(mask[1]) + 1  # add +1 because excluded max
             bbox = [xmin, ymin, xmax, ymax]
             bbox_resized = [x * P for x in bbox]  # rescale to image size
             bbox_features = [ymin, xmin, ymax, xmax]  # feature space coordinates are different
@@ -500,11 +662,12 @@ def extract_bboxes(
         --output_file "./data/VOC2012/multi_region_bboxes/fixed/bboxes_e2_d5.pth" \
     """
     utils.make_output_dir(str(Path(output_file).parent), check_if_empty=False)
-    fn = partial(_extract_bbox, num_erode=num_erode, num_dilate=num_dilate, skip_bg_index=skip_bg_index, 
-                 downsample_factor=downsample_factor)
-    inputs = utils.get_paired_input_files(features_dir, segmentations_dir)
+    fn = partial(_extract_bbox, features_dir=features_dir, num_erode=num_erode, num_dilate=num_dilate, 
+                 skip_bg_index=skip_bg_index, downsample_factor=downsample_factor)
+    inputs = utils.get_paired_feature_files(features_dir, segmentations_dir, suffix='.png')
     all_outputs = [fn(inp) for inp in tqdm(inputs, desc='Extracting bounding boxes')]
     torch.save(all_outputs, output_file)
+    utils.save_bbox_cache(all_outputs, output_file)  # for fast lookups in vis_segmentations
     print('Done')
 
 
@@ -543,12 +706,16 @@ def extract_bbox_features(
         image_filename = str(Path(images_root) / f'{image_id}.jpg')
         image = val_transform(Image.open(image_filename).convert('RGB'))  # (3, H, W)
         image = image.unsqueeze(0).to('cuda')  # (1, 3, H, W)
-        features_crops = []
-        for (xmin, ymin, xmax, ymax) in bboxes:
-            image_crop = image[:, :, ymin:ymax, xmin:xmax]
-            features_crop = model(image_crop).squeeze().cpu()
-            features_crops.append(features_crop)
-        bbox_dict['features'] = torch.stack(features_crops, dim=0)
+        # Compute a dense feature map for the full image with a single forward pass
+        P = patch_size
+        B, C, H, W = image.shape
+        H_patch, W_patch = H // P, W // P
+        tokens = model.get_intermediate_layers(image[:, :, :H_patch * P, :W_patch * P])[0]  # (1, 1 + H_patch * W_patch, D)
+        feat_map = tokens[:, 1:].reshape(B, H_patch, W_patch, -1).permute(0, 3, 1, 2)  # (1, D, H_patch, W_patch)
+        # Pool the features inside each box, where rois are given as (batch_index, xmin, ymin, xmax, ymax)
+        rois = torch.tensor([[0, *bbox] for bbox in bboxes], dtype=torch.float, device='cuda').reshape(-1, 5)
+        features_crops = roi_align(feat_map, rois, output_size=(1, 1), spatial_scale=1 / P, aligned=True)
+        bbox_dict['features'] = features_crops.flatten(1).cpu()  # (num_boxes, D)
     
     # Save
     torch.save(bbox_list, output_file)
@@ -579,18 +746,39 @@ def extract_bbox_clusters(
     print(f'Stacking and normalizing features')
     all_features = torch.cat([bbox_dict['features'] for bbox_dict in bbox_list], dim=0)  # (numBbox, D)
     all_features = all_features / torch.norm(all_features, dim=-1, keepdim=True)  # (numBbox, D)f
-    all_features = all_features.numpy()
+    all_features = all_features.float().numpy()
+
+    # Use faiss on the GPU if it is available, and sklearn otherwise
+    try:
+        import faiss
+    except ImportError:
+        faiss = None
+        print('Could not import faiss, falling back to sklearn. To install faiss:\n'
+              'conda install -c pytorch faiss-gpu')
 
     # Cluster: PCA
     if pca_dim:
-        pca = PCA(pca_dim)
         print(f'Computing PCA with dimension {pca_dim}')
-        all_features = pca.fit_transform(all_features)
+        if faiss is not None:
+            pca = faiss.PCAMatrix(all_features.shape[1], pca_dim)
+            pca.train(all_features)
+            all_features = pca.apply_py(all_features)
+        else:
+            from sklearn.decomposition import PCA
+            pca = PCA(pca_dim)
+            all_features = pca.fit_transform(all_features)
 
     # Cluster: K-Means
     print(f'Computing K-Means clustering with {num_clusters} clusters')
-    kmeans = MiniBatchKMeans(n_clusters=num_clusters, batch_size=4096, max_iter=5000, random_state=seed)
-    clusters = kmeans.fit_predict(all_features)
+    if faiss is not None:
+        kmeans = faiss.Kmeans(all_features.shape[1], num_clusters, niter=50, seed=seed, gpu=(faiss.get_num_gpus() > 0))
+        kmeans.train(all_features)
+        _, clusters = kmeans.index.search(all_features, 1)
+        clusters = clusters.squeeze(1)
+    else:
+        from sklearn.cluster import MiniBatchKMeans
+        kmeans = MiniBatchKMeans(n_clusters=num_clusters, batch_size=4096, max_iter=5000, random_state=seed)
+        clusters = kmeans.fit_predict(all_features)
     
     # Print 
     _indices, _counts = np.unique(clusters, return_counts=True)
@@ -649,8 +837,10 @@ def extract_semantic_segmentations(
         semantic_map = dict(zip(bbox_dict['segment_indices'], bbox_dict['clusters'].tolist()))
         assert 0 not in semantic_map, semantic_map
         semantic_map[0] = 0  # background region remains zero
-        # Perform mapping
-        semantic_segmap = np.vectorize(semantic_map.__getitem__)(segmap)
+        # Perform mapping with a lookup table indexed by segment id
+        lut = np.zeros(max(int(segmap.max()), max(semantic_map)) + 1, dtype=np.uint8)
+        lut[list(semantic_map.keys())] = list(semantic_map.values())
+        semantic_segmap = lut[segmap]
         # Save
         output_file = str(Path(output_dir) / f'{image_id}.png')
         Image.fromarray(semantic_segmap.astype(np.uint8)).convert('L').save(output_file)
@@ -679,8 +869,8 @@ def _extract_crf_segmentations(
 
     # Load image and segmap
     image_file = str(Path(images_root) / f'{id}.jpg')
-    image = np.array(Image.open(image_file).convert('RGB'))  # (H_patch, W_patch, 3)
-    segmap = np.array(Image.open(segmap_path))  # (H_patch, W_patch)
+    image = cv2.cvtColor(utils.imread(image_file), cv2.COLOR_BGR2RGB)  # (H_patch, W_patch, 3)
+    segmap = utils.imread(segmap_path, cv2.IMREAD_UNCHANGED)  # (H_patch, W_patch)
      
     # Sizes
     P = downsample_factor
@@ -768,86 +958,111 @@ def vis_segmentations(
     """
     # Streamlit setup
     import streamlit as st
-    from matplotlib.cm import get_cmap
-    from skimage.color import label2rgb
     st.set_page_config(layout='wide')
 
-    # Inputs
+    # Inputs, as plain strings and ids, which are resolved once here rather than in the loop below
+    image_ids = []
     image_paths = []
     segmap_paths = []
     images_root = Path(images_root)
     segmentations_dir = Path(segmentations_dir)
     for image_file in Path(images_list).read_text().splitlines():
-        segmap_file = f'{Path(image_file).stem}.png'
-        image_paths.append(images_root / image_file)
-        segmap_paths.append(segmentations_dir / segmap_file)
+        image_id = Path(image_file).stem
+        image_ids.append(image_id)
+        image_paths.append(str(images_root / image_file))
+        segmap_paths.append(str(segmentations_dir / f'{image_id}.png'))
     print(f'Found {len(image_paths)} image and segmap paths')
 
     # Load optional bounding boxes
     if bbox_file is not None:
-        bboxes_list = torch.load(bbox_file)
+        bbox_ids, bbox_offsets, bboxes_all = utils.load_bbox_cache(bbox_file)
 
     # Colors
-    colors = get_cmap('tab20', 21).colors[:, :3]
+    color_lut = _tab20_color_lut()
+
+    # Output buffers, which are allocated once per shape and reused across images
+    overlay_buffers = {}
+    row_buffers = {}
 
     # Which index
     which_index = st.number_input(label='Which index to view (0 for all)', value=0)
 
+    # Decoding, which runs ahead of the loop below in a thread pool (OpenCV releases the GIL)
+    def _load(paths: Tuple[str, str]):
+        image_path, segmap_path = paths
+        image = cv2.cvtColor(utils.imread(image_path, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+        segmap = utils.imread(segmap_path, cv2.IMREAD_UNCHANGED)
+        return image, segmap
+    loaded = utils.threaded_imap(_load, zip(image_paths, segmap_paths), num_workers=4)
+
     # Load
     total = 0
-    for i, (image_path, segmap_path) in enumerate(zip(image_paths, segmap_paths)):
+    for i, (image_id, (image, segmap)) in enumerate(zip(image_ids, loaded)):
         if total > 40: break
-        image_id = image_path.stem
-        
-        # Streamlit
-        cols = []
         
-        # Load
-        image = np.array(Image.open(image_path).convert('RGB'))
-        segmap = np.array(Image.open(segmap_path))
+        # Streamlit, where the images of a row are displayed as a single image
+        row = []
 
-        # Convert binary
-        if set(np.unique(segmap).tolist()) == {0, 255}:
-            segmap[segmap == 255] = 1
+        # Convert binary, i.e. {0, 255} -> {0, 1}
+        if segmap.max() == 255 and segmap.min() == 0 and utils.is_binary_255(segmap):
+            np.right_shift(segmap, 7, out=segmap)
 
-        # Resize
-        segmap_fullres = cv2.resize(segmap, dsize=image.shape[:2][::-1], interpolation=cv2.INTER_NEAREST)
-
-        # Only view images with a specific class
-        if which_index not in np.unique(segmap):
+        # Only view images with a specific class (or all images for 0), which is checked before any 
+        # full-resolution work
+        if which_index != 0 and not (segmap == which_index).any():
             continue
         total += 1
 
+        # Histogram of labels
+        segmap_histogram = np.bincount(segmap.ravel(), minlength=len(color_lut))
+        segmap_label_indices = np.nonzero(segmap_histogram)[0]
+
+        # Resize
+        segmap_fullres = cv2.resize(segmap, dsize=image.shape[:2][::-1], interpolation=cv2.INTER_NEAREST)
+
         # Streamlit
-        cols.append({'image': image, 'caption': image_id})
+        row.append(image)
 
         # Load optional bounding boxes
         bboxes = None
         if bbox_file is not None:
-            bboxes = torch.tensor(bboxes_list[i]['bboxes_original_resolution'])
-            assert bboxes_list[i]['id'] == image_id, f"{bboxes_list[i]['id']=} but {image_id=}"
-            image_torch = torch.from_numpy(image).permute(2, 0, 1)
-            image_with_boxes_torch = draw_bounding_boxes(image_torch, bboxes)
-            image_with_boxes = image_with_boxes_torch.permute(1, 2, 0).numpy()
+            bboxes = bboxes_all[bbox_offsets[i]:bbox_offsets[i + 1]]
+            assert bbox_ids[i] == image_id, f"{bbox_ids[i]=} but {image_id=}"
+            corners = bboxes[:, [[0, 1], [2, 1], [2, 3], [0, 3]]].astype(np.int32)  # (numBbox, 4, 2) polygons
+            image_with_boxes = cv2.polylines(image.copy(), list(corners), isClosed=True, color=(255, 0, 0), thickness=2)
             
             # Streamlit
-            cols.append({'image': image_with_boxes})
+            row.append(image_with_boxes)
             
-        # Color
-        segmap_label_indices, segmap_label_counts = np.unique(segmap, return_counts=True)
-        blank_segmap_overlay = label2rgb(label=segmap_fullres, image=np.full_like(image, 128), 
-            colors=colors[segmap_label_indices[segmap_label_indices != 0]], bg_label=0, alpha=1.0)
-        image_segmap_overlay = label2rgb(label=segmap_fullres, image=image, 
-            colors=colors[segmap_label_indices[segmap_label_indices != 0]], bg_label=0, alpha=0.45)
-        segmap_caption = dict(zip(segmap_label_indices.tolist(), (segmap_label_counts).tolist()))
+        # Color, with the lookup table shared by both overlays. As with label2rgb, the segments 
+        # are blended with the desaturated image
+        segmap_label_counts = segmap_histogram[segmap_label_indices]
+        if len(segmap_histogram) > len(color_lut):  # checked here, because the lookup below clips
+            raise IndexError(f'Label {len(segmap_histogram) - 1} in {image_id} has no color')
+        if image.shape not in overlay_buffers:
+            H, W, _ = image.shape
+            overlay_buffers[image.shape] = (np.empty((H, W, 3), dtype=np.uint8), np.empty((H, W, 3), dtype=np.uint8), 
+                                            np.empty((H, W, 3), dtype=np.float32), np.empty((H, W, 1), dtype=np.float32),
+                                            np.empty((H, W), dtype=np.intp))
+        blank_segmap_overlay, image_segmap_overlay, blend, image_gray, labels = overlay_buffers[image.shape]
+        np.copyto(labels, segmap_fullres)  # np.take would otherwise convert the indices to intp itself
+        np.take(color_lut, labels, axis=0, out=blank_segmap_overlay, mode='clip')  # (H, W, 3), unbuffered
+        np.max(image, axis=2, keepdims=True, out=image_gray)  # i.e. the value channel of HSV
+        np.multiply(image_gray, np.float32(0.55), out=image_gray)
+        np.multiply(blank_segmap_overlay, np.float32(0.45), out=blend)
+        np.add(blend, image_gray, out=blend)
+        np.copyto(image_segmap_overlay, blend, casting='unsafe')
+        segmap_caption = ' '.join(f'{l}:{c}' for l, c in zip(segmap_label_indices, segmap_label_counts))
 
         # Streamlit
-        cols.append({'image': blank_segmap_overlay, 'caption': segmap_caption})
-        cols.append({'image': image_segmap_overlay, 'caption': segmap_caption})
-
-        # Display
-        for d, col in zip(cols, st.columns(len(cols))):
-            col.image(**d)
+        row.append(blank_segmap_overlay)
+        row.append(image_segmap_overlay)
+
+        # Display, where st.image encodes the row before its buffer is reused
+        row_shape = (image.shape[0], image.shape[1] * len(row), 3)
+        if row_shape not in row_buffers:
+            row_buffers[row_shape] = np.empty(row_shape, dtype=np.uint8)
+        st.image(np.concatenate(row, axis=1, out=row_buffers[row_shape]), caption=f'{image_id}  |  {segmap_caption}')
 
 
 if __name__ == '__main__':
@@ -1,8 +1,12 @@
+import json
 import sys
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from multiprocessing import Pool
 from pathlib import Path
-from typing import Any, Callable, Iterable, Optional, Tuple, Union
+from typing import Any, Callable, Iterable, List, Optional, Tuple, Union
 
 import cv2
 import numpy as np
@@ -37,6 +41,90 @@ class ImagesDataset(Dataset):
         return len(self.filenames)
 
 
+class FeatureStore:
+    """
+    A single-file, append-only store of per-image features, keyed by image id. Tensors are
+    written back-to-back into `features.bin` and read back as memory-mapped arrays, while
+    `index.jsonl` holds one line per image with its metadata and the offsets of its tensors.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = Path(root)
+        self.data_path = self.root / 'features.bin'
+        self.index_path = self.root / 'index.jsonl'
+        self.index = {}
+        if self.index_path.is_file():
+            for line in self.index_path.read_text().splitlines():
+                record = json.loads(line)
+                self.index[record['id']] = record
+        self._data_file = self._index_file = None
+
+    def __contains__(self, id: str) -> bool:
+        return id in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def ids(self) -> List[str]:
+        return sorted(self.index.keys())
+
+    def metadata(self, id: str) -> dict:
+        """Returns the metadata of an image, without touching its tensors."""
+        return {k: v for k, v in self.index[id].items() if k != 'tensors'}
+
+    def tensor(self, id: str, name: str) -> torch.Tensor:
+        """Returns a single tensor of an image, memory-mapped from the data file."""
+        t = self.index[id]['tensors'][name]
+        array = np.memmap(self.data_path, dtype=t['dtype'], mode='c', offset=t['offset'], shape=tuple(t['shape']))
+        return torch.from_numpy(array)
+
+    def __getitem__(self, id: str) -> dict:
+        data_dict = self.metadata(id)
+        for name in self.index[id]['tensors']:
+            data_dict[name] = self.tensor(id, name)
+        return data_dict
+
+    def append(self, id: str, tensors: dict, metadata: dict) -> None:
+        if self._data_file is None:
+            self._data_file = open(self.data_path, 'ab')
+            self._index_file = open(self.index_path, 'a')
+        record = {**metadata, 'id': id, 'tensors': {}}
+        for name, tensor in tensors.items():
+            array = tensor.detach().cpu().numpy()
+            record['tensors'][name] = {'offset': self._data_file.tell(), 'dtype': array.dtype.str, 'shape': list(array.shape)}
+            self._data_file.write(array.tobytes())
+        self._data_file.flush()  # data must be on disk before it is indexed
+        self._index_file.write(json.dumps(record) + '\n')
+        self._index_file.flush()
+        self.index[id] = record
+
+    def close(self) -> None:
+        for f in (self._data_file, self._index_file):
+            if f is not None:
+                f.close()
+        self._data_file = self._index_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+@lru_cache(maxsize=None)
+def get_feature_store(root: str) -> FeatureStore:
+    """Opens a feature store for reading, once per process."""
+    return FeatureStore(root)
+
+
+def imread(path: Union[str, Path], flags: int = cv2.IMREAD_COLOR) -> np.ndarray:
+    """Like cv2.imread, but raises FileNotFoundError instead of returning None for missing or unreadable files."""
+    image = cv2.imread(str(path), flags)
+    if image is None:
+        raise FileNotFoundError(path)
+    return image
+
+
 def get_model(name: str):
     if 'dino' in name:
         model = torch.hub.load('facebookresearch/dino:main', name)
@@ -95,6 +183,101 @@ def get_paired_input_files(path1: str, path2: str):
     return list(enumerate(zip(files1, files2)))
 
 
+def get_paired_feature_files(features_dir: str, path2: str, suffix: str):
+    ids = get_feature_store(features_dir).ids()
+    return list(enumerate((id, Path(path2) / f'{id}{suffix}') for id in ids))
+
+
+def batched(iterable: Iterable, n: int):
+    batch = []
+    for x in iterable:
+        batch.append(x)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def pool_imap(pool: Pool, fn: Callable, inputs: Iterable, max_in_flight: int):
+    """Like pool.imap, but with at most max_in_flight results submitted and not yet consumed."""
+    results = deque()
+    for inp in inputs:
+        results.append(pool.apply_async(fn, (inp,)))
+        if len(results) >= max_in_flight:
+            yield results.popleft().get()
+    while results:
+        yield results.popleft().get()
+
+
+def prefetch_to_device(items: Iterable, copy_fn: Callable, device: torch.device):
+    """
+    Iterates over items copied to the device by copy_fn(item, to), where to(tensor) copies a 
+    single tensor. On CUDA, the copy of the next item runs on a side stream from pinned memory, 
+    while the current item is being processed on the compute stream.
+    """
+    if torch.device(device).type != 'cuda':
+        for item in items:
+            yield copy_fn(item, lambda t: t.to(device))
+        return
+    copy_stream = torch.cuda.Stream(device)
+    staged = None
+    for item in items:
+        copied_tensors = []
+        def to(t: torch.Tensor):
+            t = (t if t.is_pinned() else t.pin_memory()).to(device, non_blocking=True)
+            copied_tensors.append(t)
+            return t
+        with torch.cuda.stream(copy_stream):
+            item = copy_fn(item, to)
+            copied = torch.cuda.Event()
+            copied.record()
+        if staged is not None:
+            yield _wait_for_copy(*staged)
+        staged = (copied, item, copied_tensors)
+    if staged is not None:
+        yield _wait_for_copy(*staged)
+
+
+def _wait_for_copy(copied: torch.cuda.Event, item: Any, copied_tensors: List[torch.Tensor]):
+    compute_stream = torch.cuda.current_stream()
+    compute_stream.wait_event(copied)
+    for t in copied_tensors:
+        t.record_stream(compute_stream)  # memory is used on the compute stream, not the copy stream
+    return item
+
+
+def _bbox_cache_paths(bbox_file: str):
+    p = Path(bbox_file)
+    return [p.with_name(f'{p.stem}_{name}.npy') for name in ('ids', 'offsets', 'boxes')]
+
+
+def save_bbox_cache(bbox_list: List[dict], bbox_file: str) -> None:
+    """
+    Saves the boxes (at original resolution) of a bounding box list next to bbox_file, as numpy 
+    arrays of ids, offsets and concatenated boxes, which can be memory-mapped without unpickling.
+    """
+    ids = np.array([d['id'] for d in bbox_list])
+    counts = [len(d['bboxes_original_resolution']) for d in bbox_list]
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    boxes = np.array([b for d in bbox_list for b in d['bboxes_original_resolution']], dtype=np.int64).reshape(-1, 4)
+    for path, array in zip(_bbox_cache_paths(bbox_file), (ids, offsets, boxes)):
+        np.save(path, array, allow_pickle=False)
+
+
+def load_bbox_cache(bbox_file: str):
+    """
+    Memory-maps the arrays saved by save_bbox_cache, (re)creating them first if they are missing 
+    or older than bbox_file.
+    """
+    paths = _bbox_cache_paths(bbox_file)
+    source_mtime = Path(bbox_file).stat().st_mtime
+    if not all(path.is_file() and path.stat().st_mtime >= source_mtime for path in paths):
+        save_bbox_cache(torch.load(bbox_file), bbox_file)
+    ids, offsets, boxes = [np.load(path, mmap_mode='r', allow_pickle=False) for path in paths]
+    return ids, offsets, boxes
+
+
 def make_output_dir(output_dir, check_if_empty=True):
     output_dir = Path(output_dir)
     output_dir.mkdir(exist_ok=True, parents=True)
@@ -112,6 +295,16 @@ def get_largest_cc(mask: np.array):
     return largest_cc_mask
 
 
+def is_binary_255(segmap: np.ndarray) -> bool:
+    """
+    Checks whether all values of a uint8 segmap are in {0, 255}, in a single pass. Subtracting 1 
+    wraps 0 around to 255 and maps 255 to 254, so exactly the values 1..254 end up below 254. This 
+    only holds for uint8: signed dtypes do not wrap and wider dtypes have values above 255.
+    """
+    assert segmap.dtype == np.uint8, f'expected a uint8 segmap, got {segmap.dtype}'
+    return not ((segmap - np.uint8(1)) < 254).any()
+
+
 def erode_or_dilate_mask(x: Union[torch.Tensor, np.ndarray], r: int = 0, erode=True):
     fn = binary_erosion if erode else binary_dilation
     for _ in range(r):
@@ -148,6 +341,25 @@ def parallel_process(inputs: Iterable, fn: Callable, multiprocessing: int = 0):
     print(f'Finished in {time.time() - start:.1f}s')
 
 
+def kmeans(X: torch.Tensor, n_clusters: int, n_init: int = 10, n_iters: int = 20):
+    """
+    Lloyd's k-means in PyTorch, with the n_init initializations run as a single batch. 
+    Returns the cluster labels (N,) of the initialization with the lowest inertia.
+    """
+    N, D = X.shape
+    X = X.unsqueeze(0).expand(n_init, N, D)  # (I, N, D)
+    inits = torch.stack([torch.randperm(N, device=X.device)[:n_clusters] for _ in range(n_init)])
+    C = torch.gather(X, 1, inits.unsqueeze(-1).expand(-1, -1, D))  # (I, K, D)
+    for _ in range(n_iters):
+        labels = torch.cdist(X, C).argmin(dim=-1)  # (I, N)
+        sums = torch.zeros_like(C).scatter_add_(1, labels.unsqueeze(-1).expand(-1, -1, D), X)
+        counts = torch.zeros(C.shape[:2], device=X.device).scatter_add_(1, labels, torch.ones_like(labels, dtype=X.dtype))
+        C = torch.where(counts.unsqueeze(-1) > 0, sums / counts.clamp(min=1).unsqueeze(-1), C)  # keep empty clusters
+    distances, labels = torch.cdist(X, C).min(dim=-1)
+    inertia = (distances ** 2).sum(dim=-1)
+    return labels[inertia.argmin()]
+
+
 def knn_affinity(image, n_neighbors=[20, 10], distance_weights=[2.0, 0.1]):
     """Computes a KNN-based affinity matrix. Note that this function requires pymatting"""
     try: